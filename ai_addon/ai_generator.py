@@ -1,53 +1,153 @@
 """AI content generation via OpenAI or Anthropic APIs.
 
-Uses only Python standard library (urllib) to avoid extra dependencies.
+Uses the requests library bundled with Anki to avoid extra dependencies.
+A single session is shared by all calls, so connections (and their TLS
+handshakes) are reused across a batch. Responses are already compressed in
+transit: requests sends Accept-Encoding: gzip, deflate and decodes replies.
+Request bodies are sent uncompressed, because neither API documents
+accepting Content-Encoding: gzip.
 """
 
-import json
-import urllib.request
-import urllib.error
-from typing import Optional
+import functools
+import re
+from typing import Callable, Mapping, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from anki.utils import from_json_bytes, to_json_bytes
 
 import aqt
 
+from . import response_cache, semantic_cache
+
 
 class AIGenerationError(Exception):
-    pass
+    def __init__(self, message: str, headers: Optional[Mapping[str, str]] = None):
+        super().__init__(message)
+        # Response headers, if the API replied (e.g. retry-after on a 429).
+        self.headers: Mapping[str, str] = headers or {}
+
+
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3)),
+)
+
+_OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+_ANTHROPIC_URL = "https://api.anthropic.com/v1/messages"
+
+# A leading ``` or ```html fence, or a trailing ``` fence.
+_FENCE_RE = re.compile(r"\A\s*```(?:html)?\n?|```\s*\Z")
 
 
-def generate_html(front: str, prompt: str) -> str:
+def generate_html(
+    front: str,
+    prompt: str,
+    on_progress: Optional[Callable[[int], None]] = None,
+    refresh: bool = False,
+    before_request: Optional[Callable[[], None]] = None,
+) -> tuple[str, Mapping[str, str]]:
     """Generate HTML card content for a given front field value.
 
     Args:
         front: The word or phrase from the card's Front field.
         prompt: The system prompt for this deck.
+        on_progress: Called with the number of characters received so far
+            as the response streams in. Not called for cached results.
+        refresh: Ignore cached results and always call the API, e.g. when
+            the user is regenerating existing content. The new result is
+            still cached.
+        before_request: Called just before the API request is sent, so
+            callers can rate-limit real requests without delaying cache hits.
+            Exceptions it raises propagate to the caller.
 
     Returns:
-        HTML string to be stored in the AI_Content field.
+        (html, headers): the HTML string to be stored in the AI_Content
+        field, and the API response headers (empty if served from cache),
+        which carry the provider's rate-limit information.
 
     Raises:
         AIGenerationError: If the API call fails.
     """
     config = aqt.mw.addonManager.getConfig(
         aqt.mw.addonManager.addonFromModule(__name__)
-    )
-    provider = (config or {}).get("ai_provider", "openai")
+    ) or {}
+    provider = config.get("ai_provider", "openai")
+
+    model = model_name(config)
+
+    cache_key = None
+    if config.get("response_cache_enabled", True):
+        cache_key = response_cache.make_key(provider, model, prompt, front)
+        cached = None if refresh else response_cache.get(cache_key)
+        if cached is not None:
+            return cached, {}
 
+    # Near-duplicate fronts only match entries made with the same
+    # provider, model and prompt.
+    semantic_scope = None
+    query = None
+    if semantic_cache.is_enabled(config):
+        query = semantic_cache.embed(front, config)
+    if query is not None:
+        semantic_scope = response_cache.make_key(provider, model, prompt, "")
+        similar = (
+            None if refresh else semantic_cache.lookup(query, semantic_scope, config)
+        )
+        if similar is not None:
+            return similar, {}
+
+    if before_request:
+        before_request()
     if provider == "anthropic":
-        return _call_anthropic(front, prompt, config or {})
+        html, headers = _call_anthropic(front, prompt, model, config, on_progress)
     else:
-        return _call_openai(front, prompt, config or {})
+        html, headers = _call_openai(front, prompt, model, config, on_progress)
+
+    if cache_key is not None:
+        response_cache.set(cache_key, html, ttl=config.get("cache_ttl_s", 86400))
+    if semantic_scope is not None:
+        semantic_cache.add(query, front, semantic_scope, html, config)
+    return html, headers
 
 
-def _call_openai(front: str, prompt: str, config: dict) -> str:
+def model_name(config: dict) -> str:
+    """Return the model configured for the selected provider."""
+    if config.get("ai_provider", "openai") == "anthropic":
+        return config.get("anthropic_model", "claude-sonnet-4-6")
+    return config.get("openai_model", "gpt-4o")
+
+
+def _call_openai(
+    front: str,
+    prompt: str,
+    model: str,
+    config: dict,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> tuple[str, Mapping[str, str]]:
     api_key = config.get("openai_api_key", "")
     if not api_key:
         raise AIGenerationError(
             "OpenAI API key not set. Please configure it in the add-on settings."
         )
-    model = config.get("openai_model", "gpt-4o")
+    content, headers = _post_stream(
+        "OpenAI",
+        _OPENAI_URL,
+        _encode_payload(_openai_payload, model, prompt, front),
+        headers=_openai_headers(api_key),
+        delta_of=_openai_delta,
+        on_progress=on_progress,
+    )
+    return _clean_html(content), headers
 
-    payload = {
+
+def _openai_payload(model: str, prompt: str, front: str) -> dict:
+    # OpenAI caches repeated prompt prefixes automatically, so keep the
+    # per-deck system prompt first and the per-card front last.
+    return {
         "model": model,
         "messages": [
             {"role": "system", "content": prompt},
@@ -55,93 +155,187 @@ def _call_openai(front: str, prompt: str, config: dict) -> str:
         ],
         "temperature": 0.7,
         "max_tokens": 1500,
+        "stream": True,
     }
 
-    req = urllib.request.Request(
-        "https://api.openai.com/v1/chat/completions",
-        data=json.dumps(payload).encode("utf-8"),
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        method="POST",
-    )
-
-    try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            body = json.loads(resp.read().decode("utf-8"))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="replace")
-        raise AIGenerationError(
-            f"OpenAI API error {e.code}: {error_body}"
-        ) from e
-    except Exception as e:
-        raise AIGenerationError(f"Network error calling OpenAI: {e}") from e
 
-    try:
-        content = body["choices"][0]["message"]["content"]
-    except (KeyError, IndexError) as e:
-        raise AIGenerationError(f"Unexpected OpenAI response format: {body}") from e
-
-    return _clean_html(content)
+def _openai_delta(event: dict) -> str:
+    """Return the text added by one OpenAI chat.completion.chunk event."""
+    choices = event.get("choices")
+    if not choices:
+        return ""
+    return choices[0].get("delta", {}).get("content") or ""
 
 
-def _call_anthropic(front: str, prompt: str, config: dict) -> str:
+def _call_anthropic(
+    front: str,
+    prompt: str,
+    model: str,
+    config: dict,
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> tuple[str, Mapping[str, str]]:
     api_key = config.get("anthropic_api_key", "")
     if not api_key:
         raise AIGenerationError(
             "Anthropic API key not set. Please configure it in the add-on settings."
         )
-    model = config.get("anthropic_model", "claude-sonnet-4-6")
+    content, headers = _post_stream(
+        "Anthropic",
+        _ANTHROPIC_URL,
+        _encode_payload(_anthropic_payload, model, prompt, front),
+        headers=_anthropic_headers(api_key),
+        delta_of=_anthropic_delta,
+        on_progress=on_progress,
+    )
+    return _clean_html(content), headers
 
-    payload = {
+
+def _anthropic_payload(model: str, prompt: str, front: str) -> dict:
+    return {
         "model": model,
         "max_tokens": 1500,
-        "system": prompt,
+        # Mark the per-deck system prompt as cacheable, so cards from the
+        # same deck reuse it instead of being billed for it in full each time.
+        "system": [
+            {"type": "text", "text": prompt, "cache_control": {"type": "ephemeral"}}
+        ],
         "messages": [
             {"role": "user", "content": front},
         ],
+        "stream": True,
     }
 
-    req = urllib.request.Request(
-        "https://api.anthropic.com/v1/messages",
-        data=json.dumps(payload).encode("utf-8"),
-        headers={
-            "Content-Type": "application/json",
-            "x-api-key": api_key,
-            "anthropic-version": "2023-06-01",
-        },
-        method="POST",
+
+def _anthropic_delta(event: dict) -> str:
+    """Return the text added by one Anthropic message stream event."""
+    kind = event.get("type")
+    if kind == "content_block_delta":
+        delta = event.get("delta", {})
+        if delta.get("type") == "text_delta":
+            return delta.get("text", "")
+    elif kind == "error":
+        raise AIGenerationError(f"Anthropic API error: {event.get('error')}")
+    return ""
+
+
+def _encode_payload(
+    build: Callable[[str, str, str], dict], model: str, prompt: str, front: str
+) -> bytes:
+    """Return build(model, prompt, front) as JSON bytes.
+
+    Only the front changes between cards of a deck, so the rest of the
+    payload is serialized once per (build, model, prompt) and the encoded
+    front is spliced into it.
+    """
+    parts = _payload_template(build, model, prompt)
+    if parts is None:
+        return to_json_bytes(build(model, prompt, front))
+    head, tail = parts
+    return head + to_json_bytes(front) + tail
+
+
+# Stands in for the front while serializing a payload template. NUL can't
+# appear in JSON unescaped, so its encoded form won't occur elsewhere by chance.
+_FRONT_SLOT = "\0front\0"
+
+
+@functools.lru_cache(maxsize=32)
+def _payload_template(
+    build: Callable[[str, str, str], dict], model: str, prompt: str
+) -> Optional[tuple[bytes, bytes]]:
+    """Return the serialized payload split around the front, or None if the
+    slot marker can't be located unambiguously."""
+    parts = to_json_bytes(build(model, prompt, _FRONT_SLOT)).split(
+        to_json_bytes(_FRONT_SLOT)
     )
+    if len(parts) != 2:
+        return None
+    return parts[0], parts[1]
 
-    try:
-        with urllib.request.urlopen(req, timeout=60) as resp:
-            body = json.loads(resp.read().decode("utf-8"))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="replace")
-        raise AIGenerationError(
-            f"Anthropic API error {e.code}: {error_body}"
-        ) from e
-    except Exception as e:
-        raise AIGenerationError(f"Network error calling Anthropic: {e}") from e
 
+# Headers only change when the API key does, so build them once per key.
+# Callers must not mutate the returned dicts.
+@functools.lru_cache(maxsize=4)
+def _openai_headers(api_key: str) -> dict[str, str]:
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+
+
+@functools.lru_cache(maxsize=4)
+def _anthropic_headers(api_key: str) -> dict[str, str]:
+    return {
+        "Content-Type": "application/json",
+        "x-api-key": api_key,
+        "anthropic-version": "2023-06-01",
+    }
+
+
+def _post_stream(
+    service: str,
+    url: str,
+    data: bytes,
+    headers: dict,
+    delta_of: Callable[[dict], str],
+    on_progress: Optional[Callable[[int], None]] = None,
+) -> tuple[str, Mapping[str, str]]:
+    """POST a JSON body over the shared session and read the reply as a
+    stream of server-sent events.
+
+    delta_of extracts the text added by each event's JSON data.
+    Returns the concatenated text and the response headers. Raises
+    AIGenerationError if the stream closes before its terminal event
+    (OpenAI's [DONE], Anthropic's message_stop), so a truncated reply is
+    never mistaken for a complete one.
+    """
+    parts: list[str] = []
+    received = 0
+    finished = False
     try:
-        content = body["content"][0]["text"]
-    except (KeyError, IndexError) as e:
-        raise AIGenerationError(
-            f"Unexpected Anthropic response format: {body}"
-        ) from e
+        with _SESSION.post(
+            url, data=data, headers=headers, timeout=60, stream=True
+        ) as resp:
+            if not resp.ok:
+                raise AIGenerationError(
+                    f"{service} API error {resp.status_code}: {resp.text}",
+                    resp.headers,
+                )
+            for line in resp.iter_lines():
+                if not line.startswith(b"data:"):
+                    continue
+                line = line[5:].strip()
+                if line == b"[DONE]":
+                    finished = True
+                    break
+                try:
+                    event = from_json_bytes(line)
+                except ValueError as e:
+                    raise AIGenerationError(
+                        f"Unexpected {service} response format: {line!r}"
+                    ) from e
+                if event.get("type") == "message_stop":
+                    finished = True
+                    break
+                text = delta_of(event)
+                if text:
+                    parts.append(text)
+                    received += len(text)
+                    if on_progress:
+                        on_progress(received)
+            resp_headers = resp.headers
+    except AIGenerationError:
+        raise
+    except Exception as e:
+        raise AIGenerationError(f"Network error calling {service}: {e}") from e
 
-    return _clean_html(content)
+    if not finished:
+        raise AIGenerationError(f"{service} response ended early.", resp_headers)
+    if not parts:
+        raise AIGenerationError(f"{service} returned no content.", resp_headers)
+    return "".join(parts), resp_headers
 
 
 def _clean_html(text: str) -> str:
     """Strip markdown code fences if the AI wrapped the HTML in them."""
-    text = text.strip()
-    if text.startswith("```html"):
-        text = text[7:]
-    elif text.startswith("```"):
-        text = text[3:]
-    if text.endswith("```"):
-        text = text[:-3]
-    return text.strip()
+    return _FENCE_RE.sub("", text).strip()
@@ -14,6 +14,9 @@ import aqt
 
 _PROMPTS_FILENAME = "deck_prompts.json"
 
+# (mtime, prompts) of the last read or write, so unchanged files aren't reparsed.
+_cache: Optional[tuple[float, dict[str, str]]] = None
+
 
 def _prompts_path() -> str:
     addon_dir = os.path.dirname(__file__)
@@ -21,48 +24,54 @@ def _prompts_path() -> str:
 
 
 def load_all() -> dict[str, str]:
+    """Return a copy of all saved prompts, rereading the file only if it changed."""
+    global _cache
     path = _prompts_path()
-    if not os.path.exists(path):
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        _cache = None
         return {}
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    if _cache is None or _cache[0] != mtime:
+        with open(path, "r", encoding="utf-8") as f:
+            _cache = (mtime, json.load(f))
+    return dict(_cache[1])
 
 
 def save_all(prompts: dict[str, str]) -> None:
+    global _cache
     path = _prompts_path()
+    prompts = dict(prompts)
+    _cache = None
     with open(path, "w", encoding="utf-8") as f:
         json.dump(prompts, f, ensure_ascii=False, indent=2)
-
-
-def get_prompt(deck_name: str) -> str:
-    """Return the prompt for a deck, falling back to the default."""
-    prompts = load_all()
-    if deck_name in prompts:
-        return prompts[deck_name]
-    # Try parent deck names (e.g. "Japanese::N3" → "Japanese")
-    parts = deck_name.split("::")
-    for i in range(len(parts) - 1, 0, -1):
-        parent = "::".join(parts[:i])
-        if parent in prompts:
-            return prompts[parent]
+    _cache = (os.stat(path).st_mtime, prompts)
+
+
+def build_lookup(prompts: dict[str, str]) -> dict[tuple[str, ...], str]:
+    """Index a load_all() result by deck name components, for get_prompt()."""
+    return {tuple(name.split("::")): prompt for name, prompt in prompts.items()}
+
+
+def get_prompt(
+    deck_name: str, lookup: Optional[dict[tuple[str, ...], str]] = None
+) -> str:
+    """Return the prompt for a deck, falling back to the default.
+
+    Pass a build_lookup() result when resolving many decks, to avoid
+    reloading and reindexing the prompts for each one.
+    """
+    if lookup is None:
+        lookup = build_lookup(load_all())
+    # Try the deck, then its parents (e.g. "Japanese::N3" → "Japanese")
+    parts = tuple(deck_name.split("::"))
+    for i in range(len(parts), 0, -1):
+        prompt = lookup.get(parts[:i])
+        if prompt is not None:
+            return prompt
     return _default_prompt()
 
 
-def set_prompt(deck_name: str, prompt: str) -> None:
-    prompts = load_all()
-    if prompt.strip():
-        prompts[deck_name] = prompt.strip()
-    else:
-        prompts.pop(deck_name, None)
-    save_all(prompts)
-
-
-def delete_prompt(deck_name: str) -> None:
-    prompts = load_all()
-    prompts.pop(deck_name, None)
-    save_all(prompts)
-
-
 def _default_prompt() -> str:
     config = aqt.mw.addonManager.getConfig(
         aqt.mw.addonManager.addonFromModule(__name__)
@@ -6,7 +6,10 @@ Expected note type fields:
   NoteID     - stable string ID used as Supabase primary key (created by this add-on)
 """
 
+from typing import Optional
+
 from anki.notes import Note
+from anki.utils import ids2str, split_fields
 
 FRONT_FIELD = "Front"
 AI_CONTENT_FIELD = "AI_Content"
@@ -51,18 +54,37 @@ def set_ai_content(note: Note, html: str, note_id: str) -> None:
 
 def has_required_fields(note: Note) -> bool:
     """Return True if the note has both Front and AI_Content fields."""
-    field_names = {f["name"] for f in note.note_type()["flds"]}
-    return FRONT_FIELD in field_names and AI_CONTENT_FIELD in field_names
+    return _ai_content_index(note.note_type()) is not None
+
+
+def _ai_content_index(notetype: Optional[dict]) -> Optional[int]:
+    """Return the position of AI_Content in the note type's fields, or None
+    if the note type lacks Front or AI_Content."""
+    if not notetype:
+        return None
+    ords = {f["name"]: f["ord"] for f in notetype["flds"]}
+    if FRONT_FIELD not in ords:
+        return None
+    return ords.get(AI_CONTENT_FIELD)
 
 
 def notes_missing_ai_content(note_ids: list[int], col) -> list[int]:
-    """Filter note_ids to those that have an empty AI_Content field."""
-    result = []
-    for nid in note_ids:
-        try:
-            note = col.get_note(nid)
-            if has_required_fields(note) and not get_ai_content(note).strip():
-                result.append(nid)
-        except Exception:
-            pass
-    return result
+    """Filter note_ids to those that have an empty AI_Content field.
+
+    Reads the raw field data in one query rather than loading each note,
+    and inspects each note type only once.
+    """
+    ai_index_of: dict[int, Optional[int]] = {}
+    missing = set()
+    for nid, mid, flds in col.db.all(
+        "select id, mid, flds from notes where id in " + ids2str(note_ids)
+    ):
+        if mid not in ai_index_of:
+            ai_index_of[mid] = _ai_content_index(col.models.get(mid))
+        idx = ai_index_of[mid]
+        if idx is None:
+            continue
+        fields = split_fields(flds)
+        if idx < len(fields) and not fields[idx].strip():
+            missing.add(nid)
+    return [nid for nid in note_ids if nid in missing]
@@ -0,0 +1,99 @@
+"""Persistent cache of generated HTML, keyed by request contents.
+
+Entries are stored in a JSON file alongside deck_prompts.json, so
+regenerating the same word with the same provider, model and prompt
+does not issue another paid API request.
+Each entry maps a SHA-256 key to {"html": ..., "expires_at": epoch}.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+
+_CACHE_FILENAME = "response_cache.json"
+
+_lock = threading.Lock()
+_entries: Optional[dict[str, dict]] = None
+_dirty = False
+
+
+def _cache_path() -> str:
+    addon_dir = os.path.dirname(__file__)
+    return os.path.join(addon_dir, _CACHE_FILENAME)
+
+
+def make_key(provider: str, model: str, prompt: str, front: str) -> str:
+    return hashlib.sha256(
+        f"{provider}\0{model}\0{prompt}\0{front}".encode("utf-8")
+    ).hexdigest()
+
+
+def _load() -> dict[str, dict]:
+    """Return the in-memory entries, reading them from disk on first use.
+
+    Expired entries are dropped while loading. Must be called with _lock held.
+    """
+    global _entries
+    if _entries is not None:
+        return _entries
+    path = _cache_path()
+    entries: dict[str, dict] = {}
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            entries = {}
+    now = time.time()
+    _entries = {
+        key: entry
+        for key, entry in entries.items()
+        if entry.get("expires_at", 0) > now
+    }
+    return _entries
+
+
+def get(key: str) -> Optional[str]:
+    """Return the cached HTML for key, or None if missing or expired."""
+    with _lock:
+        entry = _load().get(key)
+        if entry is None:
+            return None
+        if entry["expires_at"] <= time.time():
+            return None
+        return entry["html"]
+
+
+def set(key: str, html: str, ttl: float) -> None:
+    """Store html under key for ttl seconds. Call flush() to persist."""
+    global _dirty
+    with _lock:
+        _load()[key] = {"html": html, "expires_at": time.time() + ttl}
+        _dirty = True
+
+
+def flush() -> Optional[str]:
+    """Write pending entries to disk, if anything changed since the last flush.
+
+    The file is replaced atomically, so a crash can't leave it truncated.
+    Returns a description of the error if it couldn't be written; the
+    entries stay pending for the next flush.
+    """
+    global _dirty
+    with _lock:
+        if not _dirty or _entries is None:
+            return None
+        path = _cache_path()
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(_entries, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            return f"could not save cache: {e}"
+        _dirty = False
+        return None
@@ -0,0 +1,279 @@
+"""Near-duplicate cache of generated HTML, matched by embedding similarity.
+
+Complements response_cache: when a front isn't an exact match but is very
+close to one generated before with the same provider, model and prompt
+(e.g. "走る" vs "走る (to run)"), the earlier HTML is reused.
+
+Fronts are embedded locally with an ONNX sentence-embedding model such as
+all-MiniLM-L6-v2. This needs numpy, onnxruntime and tokenizers, which are
+not bundled with Anki, plus a directory (config "semantic_cache_model_dir")
+containing model.onnx and tokenizer.json. If any of these is missing or
+fails, lookups miss and additions are skipped; last_error() says why.
+Entries are stored in semantic_cache.npz alongside deck_prompts.json, expire
+after cache_ttl_s like response_cache, and are capped at
+semantic_cache_max_entries (oldest dropped first).
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Any, Optional
+
+try:
+    import numpy as np
+    import onnxruntime
+    from tokenizers import Tokenizer
+except ImportError:
+    np = None
+
+
+_CACHE_FILENAME = "semantic_cache.npz"
+
+_lock = threading.Lock()
+_encoder: Any = None
+_encoder_failed = False
+_last_error: Optional[str] = None
+# Rows 0.._count-1 of _matrix are embeddings; row i belongs to _entries[i],
+# a {"html", "front", "scope", "expires_at"} dict. _matrix has spare rows so
+# appending doesn't copy it every time.
+_matrix: Any = None
+_count = 0
+_entries: list[dict] = []
+_max_entries = 10000
+_loaded = False
+_dirty = False
+
+
+def _cache_path() -> str:
+    addon_dir = os.path.dirname(__file__)
+    return os.path.join(addon_dir, _CACHE_FILENAME)
+
+
+class _Encoder:
+    """Mean-pooled, L2-normalised sentence embeddings from an ONNX model."""
+
+    def __init__(self, model_dir: str) -> None:
+        self._session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"),
+            providers=["CPUExecutionProvider"],
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = Tokenizer.from_file(
+            os.path.join(model_dir, "tokenizer.json")
+        )
+        self._tokenizer.enable_truncation(max_length=128)
+
+    def encode(self, text: str) -> "np.ndarray":
+        enc = self._tokenizer.encode(text)
+        mask = np.array([enc.attention_mask], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([enc.ids], dtype=np.int64),
+            "attention_mask": mask,
+            "token_type_ids": np.array([enc.type_ids], dtype=np.int64),
+        }
+        inputs = {k: v for k, v in inputs.items() if k in self._input_names}
+        tokens = self._session.run(None, inputs)[0][0]
+        weights = mask[0][:, None].astype(np.float32)
+        vec = (tokens * weights).sum(axis=0) / max(weights.sum(), 1.0)
+        norm = np.linalg.norm(vec)
+        return (vec / norm if norm else vec).astype(np.float32)
+
+
+def _get_encoder(config: dict) -> Optional[_Encoder]:
+    """Return the shared encoder, loading it on first use. Must hold _lock."""
+    global _encoder, _encoder_failed, _last_error
+    if _encoder is not None or _encoder_failed:
+        return _encoder
+    model_dir = config.get("semantic_cache_model_dir", "")
+    if np is None:
+        _last_error = "numpy, onnxruntime and tokenizers must be installed."
+    elif not model_dir:
+        _last_error = "semantic_cache_model_dir is not set."
+    else:
+        try:
+            _encoder = _Encoder(model_dir)
+        except Exception as e:
+            _last_error = f"could not load model: {e}"
+    _encoder_failed = _encoder is None
+    return _encoder
+
+
+def _load() -> None:
+    """Read stored entries from disk on first use. Must hold _lock."""
+    global _matrix, _count, _entries, _loaded, _dirty
+    if _loaded:
+        return
+    _loaded = True
+    path = _cache_path()
+    if not os.path.exists(path):
+        return
+    try:
+        with np.load(path) as data:
+            matrix = data["embeddings"].astype(np.float32)
+            entries = json.loads(data["entries"].tobytes().decode("utf-8"))
+    except (OSError, KeyError, ValueError):
+        _dirty = True
+        return
+    if matrix.ndim != 2 or len(entries) != matrix.shape[0]:
+        _dirty = True
+        return
+    now = time.time()
+    keep = [i for i, e in enumerate(entries) if e.get("expires_at", 0) > now]
+    _dirty = len(keep) != len(entries)
+    _matrix = matrix[keep]
+    _entries = [entries[i] for i in keep]
+    _count = len(_entries)
+    _trim()
+
+
+def _fit_width(dim: int) -> None:
+    """Discard stored embeddings if they come from a model of another width.
+    Must hold _lock."""
+    global _matrix, _count, _entries, _dirty
+    if _matrix is not None and _matrix.shape[1] == dim:
+        return
+    if _count:
+        _dirty = True
+    _matrix = np.zeros((64, dim), dtype=np.float32)
+    _count = 0
+    _entries = []
+
+
+def _trim() -> None:
+    """Drop the oldest entries beyond _max_entries. Must hold _lock."""
+    global _matrix, _count, _entries, _dirty
+    excess = _count - _max_entries
+    if excess <= 0:
+        return
+    _matrix = _matrix[excess:_count].copy()
+    _entries = _entries[excess:]
+    _count = len(_entries)
+    _dirty = True
+
+
+def is_enabled(config: dict) -> bool:
+    return bool(config.get("semantic_cache_enabled", False))
+
+
+def last_error() -> Optional[str]:
+    """Return why the cache last failed to load or run, if it has."""
+    return _last_error
+
+
+def clear_error() -> None:
+    """Forget earlier failures; call when a generation run starts.
+
+    A model that failed to load is tried again, so its error is reported
+    again if it still fails.
+    """
+    global _encoder_failed, _last_error
+    with _lock:
+        _encoder_failed = False
+        _last_error = None
+
+
+def embed(front: str, config: dict) -> "Optional[np.ndarray]":
+    """Return the embedding of front, or None if the cache can't run.
+
+    Pass the result to lookup() and add(), so a front is embedded once.
+    """
+    global _last_error
+    with _lock:
+        encoder = _get_encoder(config)
+    if encoder is None:
+        return None
+    try:
+        return encoder.encode(front)
+    except Exception as e:
+        _last_error = f"could not embed {front!r}: {e}"
+        return None
+
+
+def lookup(query: "np.ndarray", scope: str, config: dict) -> Optional[str]:
+    """Return HTML cached for a front similar to the embedded query, or None.
+
+    scope identifies the provider, model and prompt; only entries created
+    with the same scope can match. Never raises; failures count as a miss.
+    """
+    global _last_error
+    threshold = config.get("semantic_cache_threshold", 0.95)
+    with _lock:
+        try:
+            _load()
+            _fit_width(query.shape[0])
+            if not _count:
+                return None
+            sims = _matrix[:_count] @ query
+            now = time.time()
+            for i in np.argsort(sims)[::-1]:
+                if sims[i] <= threshold:
+                    break
+                entry = _entries[i]
+                if entry["scope"] == scope and entry["expires_at"] > now:
+                    return entry["html"]
+        except Exception as e:
+            _last_error = f"lookup failed: {e}"
+    return None
+
+
+def add(
+    vec: "np.ndarray", front: str, scope: str, html: str, config: dict
+) -> None:
+    """Remember html for front, whose embedding is vec. Call flush() to persist.
+
+    Never raises; failures just skip the entry.
+    """
+    global _matrix, _count, _max_entries, _dirty, _last_error
+    with _lock:
+        try:
+            _max_entries = int(config.get("semantic_cache_max_entries", 10000))
+            _load()
+            _fit_width(vec.shape[0])
+            if _count == _matrix.shape[0]:
+                grown = np.zeros(
+                    (max(_count * 2, 64), _matrix.shape[1]), dtype=np.float32
+                )
+                grown[:_count] = _matrix
+                _matrix = grown
+            _matrix[_count] = vec
+            _count += 1
+            _entries.append(
+                {
+                    "html": html,
+                    "front": front,
+                    "scope": scope,
+                    "expires_at": time.time() + config.get("cache_ttl_s", 86400),
+                }
+            )
+            _dirty = True
+            if _count > _max_entries * 1.1:
+                _trim()
+        except Exception as e:
+            _last_error = f"could not store entry: {e}"
+
+
+def flush() -> None:
+    """Write pending entries to disk, if anything changed since the last flush."""
+    global _dirty, _last_error
+    with _lock:
+        if not _dirty or np is None:
+            return
+        try:
+            if _matrix is not None:
+                _trim()
+            entries = json.dumps(_entries, ensure_ascii=False).encode("utf-8")
+            embeddings = (
+                _matrix[:_count]
+                if _matrix is not None
+                else np.zeros((0, 0), dtype=np.float32)
+            )
+            with open(_cache_path(), "wb") as f:
+                np.savez_compressed(
+                    f,
+                    embeddings=embeddings,
+                    entries=np.frombuffer(entries, dtype=np.uint8),
+                )
+            _dirty = False
+        except OSError as e:
+            _last_error = f"could not save cache: {e}"
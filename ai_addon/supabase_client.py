@@ -1,15 +1,18 @@
 """Supabase REST API client.
 
-Uses only Python standard library (urllib) to avoid extra dependencies.
-Communicates with Supabase via its PostgREST HTTP API.
+Uses the requests library bundled with Anki to avoid extra dependencies.
+Communicates with Supabase via its PostgREST HTTP API, reusing pooled
+keep-alive connections across calls.
 """
 
-import json
-import urllib.request
-import urllib.error
-import urllib.parse
 from typing import Optional
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from anki.utils import from_json_bytes, to_json_bytes
+
 import aqt
 
 
@@ -17,6 +20,13 @@ class SupabaseError(Exception):
     pass
 
 
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_maxsize=16, max_retries=Retry(total=3, backoff_factor=0.3)),
+)
+
+
 def _get_config() -> tuple[str, str, str]:
     """Return (url, anon_key, table_name) from add-on config."""
     config = aqt.mw.addonManager.getConfig(
@@ -33,6 +43,25 @@ def is_configured() -> bool:
     return bool(url and key)
 
 
+def make_row(
+    note_id: str,
+    deck_name: str,
+    front: str,
+    ai_content: str,
+    model_used: str = "",
+    prompt_used: str = "",
+) -> dict:
+    """Build an ai_card_content row for upsert_many()."""
+    return {
+        "note_id": note_id,
+        "deck_name": deck_name,
+        "front": front,
+        "ai_content": ai_content,
+        "model_used": model_used,
+        "prompt_used": prompt_used,
+    }
+
+
 def upsert(
     note_id: str,
     deck_name: str,
@@ -46,42 +75,39 @@ def upsert(
     Silently skips if Supabase is not configured.
     Raises SupabaseError on network/API failures.
     """
+    upsert_many(
+        [make_row(note_id, deck_name, front, ai_content, model_used, prompt_used)]
+    )
+
+
+def upsert_many(rows: list[dict]) -> None:
+    """Insert or update several rows (see make_row()) in one request.
+
+    Silently skips if Supabase is not configured or rows is empty.
+    Raises SupabaseError on network/API failures.
+    """
     url, key, table = _get_config()
-    if not url or not key:
+    if not url or not key or not rows:
         return
 
     endpoint = f"{url}/rest/v1/{table}"
-    payload = {
-        "note_id": note_id,
-        "deck_name": deck_name,
-        "front": front,
-        "ai_content": ai_content,
-        "model_used": model_used,
-        "prompt_used": prompt_used,
+    headers = {
+        "Content-Type": "application/json",
+        "apikey": key,
+        "Authorization": f"Bearer {key}",
+        "Prefer": "resolution=merge-duplicates,return=minimal",
     }
 
-    req = urllib.request.Request(
-        endpoint,
-        data=json.dumps(payload).encode("utf-8"),
-        headers={
-            "Content-Type": "application/json",
-            "apikey": key,
-            "Authorization": f"Bearer {key}",
-            "Prefer": "resolution=merge-duplicates",
-        },
-        method="POST",
-    )
-
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            resp.read()
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="replace")
-        raise SupabaseError(
-            f"Supabase upsert failed ({e.code}): {error_body}"
-        ) from e
+        resp = _SESSION.post(
+            endpoint, data=to_json_bytes(rows), headers=headers, timeout=30
+        )
     except Exception as e:
         raise SupabaseError(f"Network error calling Supabase: {e}") from e
+    if not resp.ok:
+        raise SupabaseError(
+            f"Supabase upsert failed ({resp.status_code}): {resp.text}"
+        )
 
 
 def fetch(note_id: str) -> Optional[dict]:
@@ -90,28 +116,28 @@ def fetch(note_id: str) -> Optional[dict]:
     if not url or not key:
         return None
 
-    params = urllib.parse.urlencode({"note_id": f"eq.{note_id}"})
-    endpoint = f"{url}/rest/v1/{table}?{params}"
-
-    req = urllib.request.Request(
-        endpoint,
-        headers={
-            "apikey": key,
-            "Authorization": f"Bearer {key}",
-        },
-        method="GET",
-    )
+    endpoint = f"{url}/rest/v1/{table}"
 
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            rows = json.loads(resp.read().decode("utf-8"))
-    except urllib.error.HTTPError as e:
-        error_body = e.read().decode("utf-8", errors="replace")
-        raise SupabaseError(
-            f"Supabase fetch failed ({e.code}): {error_body}"
-        ) from e
+        resp = _SESSION.get(
+            endpoint,
+            params={"note_id": f"eq.{note_id}"},
+            headers={
+                "apikey": key,
+                "Authorization": f"Bearer {key}",
+            },
+            timeout=30,
+        )
     except Exception as e:
         raise SupabaseError(f"Network error calling Supabase: {e}") from e
+    if not resp.ok:
+        raise SupabaseError(
+            f"Supabase fetch failed ({resp.status_code}): {resp.text}"
+        )
+    try:
+        rows = from_json_bytes(resp.content)
+    except ValueError as e:
+        raise SupabaseError(f"Unexpected Supabase response: {resp.text}") from e
 
     return rows[0] if rows else None
 
@@ -27,6 +27,8 @@ class DeckPromptDialog(QDialog):
         super().__init__(parent)
         self.setWindowTitle("AI Prompts by Deck")
         self.resize(800, 500)
+        # The dialog owns the prompts while open; edits are written through.
+        self._all_prompts = deck_prompts.load_all()
         self._build_ui()
         self._load_decks()
 
@@ -83,16 +85,19 @@ class DeckPromptDialog(QDialog):
 
     def _load_decks(self) -> None:
         col = aqt.mw.col
-        all_prompts = deck_prompts.load_all()
-        for deck in sorted(col.decks.all(), key=lambda d: d["name"]):
-            name = deck["name"]
-            item = QListWidgetItem(name)
-            if name in all_prompts:
-                item.setToolTip("Custom prompt configured")
-                font = item.font()
-                font.setBold(True)
-                item.setFont(font)
-            self.deck_list.addItem(item)
+        names = [d.name for d in col.decks.all_names_and_ids()]
+        self.deck_list.setUpdatesEnabled(False)
+        try:
+            self.deck_list.addItems(names)
+            # Usually only a few decks have custom prompts, so style just those.
+            for name in self._all_prompts:
+                for item in self.deck_list.findItems(name, Qt.MatchFlag.MatchExactly):
+                    item.setToolTip("Custom prompt configured")
+                    font = item.font()
+                    font.setBold(True)
+                    item.setFont(font)
+        finally:
+            self.deck_list.setUpdatesEnabled(True)
 
     def _on_deck_selected(
         self, current: QListWidgetItem, previous: QListWidgetItem
@@ -101,8 +106,7 @@ class DeckPromptDialog(QDialog):
             return
         deck_name = current.text()
         self.prompt_label.setText(f"Prompt for: <b>{deck_name}</b>")
-        all_prompts = deck_prompts.load_all()
-        self.prompt_editor.setPlainText(all_prompts.get(deck_name, ""))
+        self.prompt_editor.setPlainText(self._all_prompts.get(deck_name, ""))
         self.prompt_editor.setEnabled(True)
         self.save_btn.setEnabled(True)
         self.clear_btn.setEnabled(True)
@@ -116,14 +120,19 @@ class DeckPromptDialog(QDialog):
         if not name:
             return
         text = self.prompt_editor.toPlainText()
-        deck_prompts.set_prompt(name, text)
+        if text.strip():
+            self._all_prompts[name] = text.strip()
+        else:
+            self._all_prompts.pop(name, None)
+        deck_prompts.save_all(self._all_prompts)
         self._refresh_item_style(name, bold=bool(text.strip()))
 
     def _clear_current(self) -> None:
         name = self._current_deck_name()
         if not name:
             return
-        deck_prompts.delete_prompt(name)
+        self._all_prompts.pop(name, None)
+        deck_prompts.save_all(self._all_prompts)
         self.prompt_editor.setPlainText("")
         self._refresh_item_style(name, bold=False)
 
@@ -1,8 +1,17 @@
 """Progress dialog shown while AI content is being generated."""
 
+from __future__ import annotations
+
+import threading
 import time
-from typing import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Mapping, NamedTuple, Optional, Sequence
+
+from anki.collection import Collection
+from anki.notes import Note
+from anki.utils import ids2str
 
+from aqt.operations import QueryOp
 from aqt.qt import (
     QDialog,
     QDialogButtonBox,
@@ -17,7 +26,14 @@ from aqt.qt import (
 from aqt.utils import showWarning
 import aqt
 
-from .. import ai_generator, deck_prompts, note_manager, supabase_client
+from .. import (
+    ai_generator,
+    deck_prompts,
+    note_manager,
+    response_cache,
+    semantic_cache,
+    supabase_client,
+)
 
 
 class GenerateDialog(QDialog):
@@ -31,6 +47,7 @@ class GenerateDialog(QDialog):
         super().__init__(parent)
         self.note_ids = list(note_ids)
         self._cancelled = False
+        self._running = False
         self.setWindowTitle("Generating AI Content")
         self.resize(500, 350)
         self._build_ui()
@@ -74,96 +91,346 @@ class GenerateDialog(QDialog):
             self.log.verticalScrollBar().maximum()
         )
 
+    def _post_log(self, msg: str) -> None:
+        """Append msg to the log from a background thread."""
+        aqt.mw.taskman.run_on_main(lambda: self._log(msg))
+
+    def _post_status(self, msg: str) -> None:
+        aqt.mw.taskman.run_on_main(lambda: self.status_label.setText(msg))
+
+    def _post_advance(self) -> None:
+        aqt.mw.taskman.run_on_main(self._advance)
+
     def _cancel(self) -> None:
         self._cancelled = True
-        self._log("Cancelling after current card...")
+        self._log("Cancelling after in-flight cards...")
+
+    def reject(self) -> None:
+        # Don't close the dialog underneath a running generation.
+        if self._running:
+            self._cancel()
+            return
+        super().reject()
+
+    def _advance(self) -> None:
+        self.progress_bar.setValue(self.progress_bar.value() + 1)
 
     def _run(self) -> None:
         self.run_btn.setEnabled(False)
+        self._running = True
         config = aqt.mw.addonManager.getConfig(
             aqt.mw.addonManager.addonFromModule(__name__)
         ) or {}
-        delay_ms = config.get("request_delay_ms", 500)
+        QueryOp(
+            parent=self,
+            op=lambda col: self._generate_all(col, config),
+            success=self._on_done,
+        ).failure(self._on_failed).run_in_background()
+
+    def _generate_all(self, col: Collection, config: dict) -> int:
+        """Generate content for all notes. Runs on a background thread.
 
-        col = aqt.mw.col
+        Returns the number of errors.
+        """
+        delay_ms = config.get("request_delay_ms", 500)
+        concurrency = max(1, int(config.get("concurrency", 5)))
         errors = 0
+        model_used = ai_generator.model_name(config)
+        # Only warn about semantic cache failures from this run.
+        semantic_cache.clear_error()
 
-        for i, nid in enumerate(self.note_ids):
-            if self._cancelled:
-                self._log("Cancelled.")
-                break
+        # Look up every note's deck and prompt up front rather than per note.
+        deck_of = _deck_names_of_notes(col, self.note_ids)
+        prompt_lookup = deck_prompts.build_lookup(deck_prompts.load_all())
+        prompt_of: dict[str, str] = {}
 
+        jobs: list[_Job] = []
+        for i, nid in enumerate(self.note_ids):
             try:
                 note = col.get_note(nid)
             except Exception as e:
-                self._log(f"[{i+1}] ERROR loading note {nid}: {e}")
+                self._post_log(f"[{i+1}] ERROR loading note {nid}: {e}")
                 errors += 1
+                self._post_advance()
                 continue
 
             front = note_manager.get_front(note)
             if not front:
-                self._log(f"[{i+1}] SKIP note {nid}: Front field is empty.")
-                self.progress_bar.setValue(i + 1)
+                self._post_log(f"[{i+1}] SKIP note {nid}: Front field is empty.")
+                self._post_advance()
                 continue
 
-            deck_id = col.cards_of_note(nid)[0].did
-            deck_name = col.decks.name(deck_id)
-            prompt = deck_prompts.get_prompt(deck_name)
+            deck_name = deck_of.get(nid)
+            if deck_name is None:
+                self._post_log(f"[{i+1}] SKIP note {nid}: note has no cards.")
+                self._post_advance()
+                continue
+            if deck_name not in prompt_of:
+                prompt_of[deck_name] = deck_prompts.get_prompt(
+                    deck_name, prompt_lookup
+                )
+            prompt = prompt_of[deck_name]
+            # Regenerating existing content should produce a fresh result,
+            # not the cached one.
+            refresh = bool(note_manager.get_ai_content(note).strip())
+            jobs.append(_Job(i, nid, note, front, deck_name, prompt, refresh))
+
+        # Send each deck's cards back to back so provider-side prompt
+        # caching sees the same system prompt on consecutive requests.
+        jobs.sort(key=lambda job: job.deck_name)
+
+        throttle = _Throttle(delay_ms / 1000.0)
+        updated: list[Note] = []
+        pending_rows: list[dict] = []
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                futures = [
+                    pool.submit(self._process_one, job, throttle) for job in jobs
+                ]
+                try:
+                    for fut in as_completed(futures):
+                        if self._cancelled:
+                            for other in futures:
+                                other.cancel()
+                        if fut.cancelled():
+                            continue
+                        errors += self._collect_result(
+                            *fut.result(), model_used, updated, pending_rows
+                        )
+                        if len(updated) >= _SAVE_BATCH_SIZE:
+                            errors += self._save_batch(col, updated, pending_rows)
+                            updated.clear()
+                            pending_rows.clear()
+                except BaseException:
+                    # Don't let queued jobs keep making paid requests whose
+                    # results would be discarded.
+                    for other in futures:
+                        other.cancel()
+                    raise
+        finally:
+            # Keep whatever was generated, even if the run failed part way.
+            errors += self._save_batch(col, updated, pending_rows)
+            response_error = response_cache.flush()
+            if response_error:
+                self._post_log(f"Response cache warning: {response_error}")
+            semantic_cache.flush()
+
+        semantic_error = semantic_cache.last_error()
+        if semantic_cache.is_enabled(config) and semantic_error:
+            self._post_log(f"Semantic cache warning: {semantic_error}")
+        if self._cancelled:
+            self._post_log("Cancelled.")
+        return errors
 
-            self.status_label.setText(
-                f"[{i+1}/{len(self.note_ids)}] Generating: {front[:50]}"
+    def _collect_result(
+        self,
+        job: _Job,
+        html: Optional[str],
+        error: Optional[str],
+        model_used: str,
+        updated: list[Note],
+        pending_rows: list[dict],
+    ) -> int:
+        """Apply one _process_one() result to its note and queue it for the
+        next batch save. Returns the number of errors (0 or 1)."""
+        i, nid, note, front = job.index, job.nid, job.note, job.front
+        if html is None and error is None:
+            return 0
+        if html is None:
+            self._post_log(f"[{i+1}] ERROR for '{front}': {error}")
+            self._post_advance()
+            return 1
+
+        # Write back to note; saved in batches by the caller
+        try:
+            note_manager.set_ai_content(note, html, str(nid))
+        except Exception as e:
+            self._post_log(f"[{i+1}] ERROR saving note {nid}: {e}")
+            self._post_advance()
+            return 1
+        updated.append(note)
+        pending_rows.append(
+            supabase_client.make_row(
+                note_id=str(nid),
+                deck_name=job.deck_name,
+                front=front,
+                ai_content=html,
+                model_used=model_used,
+                prompt_used=job.prompt,
             )
-            # Let the UI update
-            aqt.mw.app.processEvents()
+        )
 
-            try:
-                html = ai_generator.generate_html(front, prompt)
-            except ai_generator.AIGenerationError as e:
-                self._log(f"[{i+1}] ERROR for '{front}': {e}")
-                errors += 1
-                self.progress_bar.setValue(i + 1)
-                continue
+        self._post_log(f"[{i+1}] OK: {front}")
+        self._post_advance()
+        return 0
 
-            # Write back to note
-            model_used = _model_label(config)
-            try:
-                note_manager.set_ai_content(note, html, str(nid))
-                col.update_note(note)
-            except Exception as e:
-                self._log(f"[{i+1}] ERROR saving note {nid}: {e}")
-                errors += 1
-                self.progress_bar.setValue(i + 1)
-                continue
+    def _save_batch(
+        self, col: Collection, notes: list[Note], rows: list[dict]
+    ) -> int:
+        """Save notes in a single transaction, then sync their rows to Supabase
+        in a single request. Returns the number of errors.
 
-            # Sync to Supabase (non-fatal)
-            try:
-                supabase_client.upsert(
-                    note_id=str(nid),
-                    deck_name=deck_name,
-                    front=front,
-                    ai_content=html,
-                    model_used=model_used,
-                    prompt_used=prompt,
-                )
-            except supabase_client.SupabaseError as e:
-                self._log(f"[{i+1}] Supabase warning for '{front}': {e}")
+        The changes are not undoable. This runs inside a QueryOp, which
+        doesn't tell the UI about undo entries, so none are created.
+        """
+        if not notes:
+            return 0
+        try:
+            col.update_notes(notes, skip_undo_entry=True)
+        except Exception as e:
+            self._post_log(f"ERROR saving {len(notes)} note(s): {e}")
+            return len(notes)
+
+        # Sync to Supabase (non-fatal)
+        try:
+            supabase_client.upsert_many(rows)
+        except supabase_client.SupabaseError as e:
+            self._post_log(f"Supabase warning for {len(rows)} card(s): {e}")
+        return 0
+
+    def _process_one(
+        self, job: _Job, throttle: _Throttle
+    ) -> tuple[_Job, Optional[str], Optional[str]]:
+        """Generate HTML for one note. Runs on a worker thread; touches no Qt
+        or collection state.
 
-            self._log(f"[{i+1}] OK: {front}")
-            self.progress_bar.setValue(i + 1)
+        Returns (job, html, error). html is None if generation failed, and
+        both are None if the run was cancelled before the request was sent.
+        """
+        if self._cancelled:
+            return job, None, None
+        label = f"[{job.index+1}/{len(self.note_ids)}] Generating: {job.front[:50]}"
+        self._post_status(label)
+        last_update = 0.0
+
+        def on_progress(received: int) -> None:
+            nonlocal last_update
+            # Streams deliver many small chunks; don't flood the UI thread.
+            now = time.monotonic()
+            if now - last_update >= 0.2:
+                last_update = now
+                self._post_status(f"{label} ({received} characters)")
+
+        def before_request() -> None:
+            # Only real API requests are spaced out; cache hits skip this.
+            throttle.wait()
+            if self._cancelled:
+                raise _Cancelled()
 
-            if i < len(self.note_ids) - 1:
-                time.sleep(delay_ms / 1000.0)
-                aqt.mw.app.processEvents()
+        try:
+            html, headers = ai_generator.generate_html(
+                job.front,
+                job.prompt,
+                on_progress=on_progress,
+                refresh=job.refresh,
+                before_request=before_request,
+            )
+        except _Cancelled:
+            return job, None, None
+        except ai_generator.AIGenerationError as e:
+            throttle.update(e.headers)
+            return job, None, str(e)
+        except Exception as e:
+            return job, None, f"{type(e).__name__}: {e}"
+        throttle.update(headers)
+        return job, html, None
 
-        col.save()
+    def _on_done(self, errors: int) -> None:
+        self._running = False
         summary = f"Done. {len(self.note_ids)} card(s) processed, {errors} error(s)."
         self.status_label.setText(summary)
         self._log(f"\n{summary}")
         self.close_btn.setEnabled(True)
 
+    def _on_failed(self, exc: Exception) -> None:
+        self._running = False
+        self.status_label.setText("Generation failed.")
+        self._log(f"\nERROR: {exc}")
+        self.close_btn.setEnabled(True)
+
+
+# Number of generated notes written per col.update_notes() call and
+# per Supabase upsert request.
+_SAVE_BATCH_SIZE = 50
+
+
+class _Cancelled(Exception):
+    """Raised before a request is sent once the user has cancelled."""
+
+
+class _Job(NamedTuple):
+    index: int
+    nid: int
+    note: Note
+    front: str
+    deck_name: str
+    prompt: str
+    refresh: bool
+
+
+class _Throttle:
+    """Spaces out request starts across threads.
+
+    Starts are `interval` seconds apart by default. Rate-limit headers from
+    API responses adjust this: plenty of remaining requests drops the gap to
+    zero, and retry-after holds all requests back for the given time.
+    """
+
+    def __init__(self, interval: float) -> None:
+        self._interval = interval
+        self._gap = interval
+        self._next_start = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._gap
+        if start > now:
+            time.sleep(start - now)
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        retry_after = _header_number(headers, "retry-after")
+        remaining = _header_number(
+            headers,
+            "x-ratelimit-remaining-requests",
+            "anthropic-ratelimit-requests-remaining",
+        )
+        with self._lock:
+            if retry_after is not None:
+                self._next_start = max(
+                    self._next_start, time.monotonic() + retry_after
+                )
+                self._gap = self._interval
+            elif remaining is not None:
+                self._gap = 0.0 if remaining > _RATE_LIMIT_HEADROOM else self._interval
+
+
+# Skip request_delay_ms while the provider reports more remaining requests
+# than this.
+_RATE_LIMIT_HEADROOM = 10
+
+
+def _header_number(headers: Mapping[str, str], *names: str) -> Optional[float]:
+    """Return the first of the named headers that holds a number, if any."""
+    for name in names:
+        try:
+            return float(headers[name])
+        except (KeyError, ValueError):
+            continue
+    return None
+
 
-def _model_label(config: dict) -> str:
-    provider = config.get("ai_provider", "openai")
-    if provider == "anthropic":
-        return config.get("anthropic_model", "claude-sonnet-4-6")
-    return config.get("openai_model", "gpt-4o")
+def _deck_names_of_notes(col: Collection, note_ids: Sequence[int]) -> dict[int, str]:
+    """Map each note id to the deck name of its first card, in one query."""
+    # SQLite takes the bare did column from the row matching min(ord).
+    rows = col.db.all(
+        "select nid, did, min(ord) from cards where nid in "
+        + ids2str(note_ids)
+        + " group by nid"
+    )
+    names: dict[int, str] = {}
+    for did in {did for _, did, _ in rows}:
+        names[did] = col.decks.name(did)
+    return {nid: names[did] for nid, did, _ in rows}